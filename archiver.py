@@ -14,195 +14,2964 @@
 # limitations under the License.
 
 from paramiko.client import AutoAddPolicy, SSHClient
-from datetime import date
-from collections import namedtuple
+from paramiko.ssh_exception import SSHException
+from datetime import date, datetime, timedelta
+from collections import Counter, deque, namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+from Queue import PriorityQueue, Queue
+from StringIO import StringIO
 import argparse
+import errno
+import fnmatch
 import progressbar
 import gzip
+import hashlib
+import itertools
 import re
+import shutil
 import os
 import os.path
+import pipes
+import posixpath
+import sqlite3
+import stat
+import string
+import struct
+import sys
+import threading
+import time
 import yaml
+import zlib
 
+try:
+    from scandir import walk
+except ImportError:
+    walk = os.walk
 
-FIND_COMMAND_TEMPLATE = 'find %(dir)s -name "%(glob)s"'
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+# Lists matching files along with their size, last modified time and inode,
+# separated by tabs. Paths come last and entries are NUL terminated, so that
+# odd characters in file names can't confuse the parsing.
+FIND_COMMAND_TEMPLATE = (
+    'find %(dir)s %(names)s -printf "%%s\\t%%T@\\t%%i\\t%%p\\0"'
+)
+# Succeeds only if the remote's `find` supports `-printf`
+FIND_PRINTF_PROBE = 'find / -maxdepth 0 -printf ""'
 DATE_REGEX = re.compile("(20[0-9][0-9])-([0-9][0-9])-([0-9][0-9])")
 
+# When we know the date of the newest file archived for a service and host,
+# only files from this many days before it onwards are looked for on the
+# remote, so that anything that failed in recent runs is still retried. If
+# that means looking for more than MAX_SCAN_DAYS days of files we just look
+# for all of them.
+SCAN_MARGIN_DAYS = 7
+MAX_SCAN_DAYS = 62
+
+# With `--remove`, archived files are removed from the remote in batches of up
+# to this many files, or this many bytes of paths, with one `rm` each.
+REMOVE_BATCH_SIZE = 200
+REMOVE_BATCH_BYTES = 64 * 1024
+
+# Files at least twice this size are split into segments of at least this
+# size to be downloaded in parallel, if a service is configured to do so.
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024
+
+# The most sessions (SFTP channels and remote commands) we open at once on a
+# connection, which is the default `MaxSessions` of OpenSSH's sshd.
+MAX_SESSIONS = 10
+
+# Where files are put in the archive directory, see `Layout`. By default all
+# of the files for a service and host go in one directory.
+DEFAULT_LAYOUT = "{service}/{host}/{file}"
+
+# Defaults for how remote files are read: the size of each read and how many
+# of them we keep in flight at once.
+DEFAULT_READ_BLOCK_SIZE = 256 * 1024
+DEFAULT_READ_WINDOW = 32
+
+# Number of downloaded blocks that can be queued up waiting to be compressed
+# before the download has to wait for the compressor to catch up.
+PIPELINE_BUFFERS = 16
+
+# Size of the blocks input is split into when compressing with multiple
+# threads. Each block is compressed independently, so making these too small
+# hurts the compression ratio.
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+# How much uncompressed data to write between checkpoints when compressing,
+# i.e. the most that has to be downloaded again if a download is interrupted.
+RESUME_CHECKPOINT_SIZE = 64 * 1024 * 1024
+
+RATE_REGEX = re.compile(r"^([0-9]+(?:\.[0-9]+)?)\s*([KMG]?)$", re.IGNORECASE)
+RATE_SUFFIXES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+# How often to check whether a rate limit of zero (i.e. paused) has changed
+RATE_PAUSE_CHECK_SECONDS = 10
+
+# Compression level that can be configured to have the level picked
+# automatically based on how fast files are downloading.
+ADAPTIVE_LEVEL = "adaptive"
+
+
+# Files with these extensions are already compressed, so are archived as is
+# rather than being compressed again.
+COMPRESSED_EXTENSIONS = (".gz", ".bz2", ".xz", ".lzma", ".zst", ".lz4")
+
+
+# A file on a remote, as returned by listing the service's directory. The
+# inode is None if it couldn't be determined.
+RemoteFile = namedtuple("RemoteFile", ("path", "size", "mtime", "inode"))
+
+
+Service = namedtuple("Service", (
+    "name", "host", "account", "directory", "pattern",
+    "days_to_keep_on_remote", "retention_period_days", "sftp_channels",
+    "read_block_size", "read_window", "codec", "compression_level",
+    "remote_compression", "bandwidth_limit", "segments",
+))
+
+
+def date_key(file_name):
+    """Get the date in a file name as an integer, e.g. 20170131, so that
+    dates can be compared and stored cheaply.
+
+    Returns:
+        int|None: None if there is no date in the name
+    """
+    m = DATE_REGEX.search(file_name)
+    if not m:
+        return None
+    return int(m.group(1) + m.group(2) + m.group(3))
+
+
+def filter_older_than(files, days):
+    """Get the files with a date in their name more than the given number of
+    days before today.
+
+    Args:
+        files (iterable): filenames with a date in them
+        days (int)
+
+    Returns:
+        list: The filtered list of files, oldest first
+    """
+    files = list(files)
+
+    # Dates in the form YYYY-MM-DD sort the same as strings as they do as
+    # dates, so we can compare them without parsing them.
+    cutoff = (date.today() - timedelta(days=days)).isoformat()
+
+    matches = itertools.imap(DATE_REGEX.search, files)
+
+    results = []
+    for f, m in itertools.izip(files, matches):
+        if m is not None:
+            f_date = m.group(0)
+            if f_date < cutoff:
+                results.append((f_date, f))
+
+    results.sort()
+    return [f for _, f in results]
+
+
+def download(sftp, remote_path, fileobj, block_size=DEFAULT_READ_BLOCK_SIZE,
+             window=DEFAULT_READ_WINDOW, callback=None, digest=None,
+             offset=0, size=None, throttle=None):
+    """Download a remote file into a local file object, pipelining reads so
+    that throughput isn't bounded by the round trip time to the remote.
+
+    The file is requested in batches of blocks, and the next batch is always
+    requested before the current one is written out, so that up to `window`
+    blocks are in flight at any one time.
+
+    Args:
+        sftp(SFTPClient)
+        remote_path(str): Path of the file on the remote
+        fileobj(file): Local file object to write the contents to
+        block_size(int): Size in bytes of each read
+        window(int): Maximum number of reads to have in flight at once
+        callback(func): Called with the number of bytes downloaded so far
+            and the total size of the file after each block is written
+        digest: A hashlib object to update with the downloaded data, if any
+        offset(int): Where in the remote file to start downloading from
+        size(int): Size of the remote file, if already known
+        throttle(func): Called with the size of each block before it is
+            written, and may block to limit the rate of the download
+
+    Returns:
+        int: The number of bytes downloaded
+    """
+    start = offset
+    batch_size = max(window // 2, 1)
+
+    with sftp.open(remote_path, "rb") as remote:
+        if size is None:
+            size = remote.stat().st_size
+
+        def batches():
+            offset = start
+            while offset < size:
+                batch = []
+                while offset < size and len(batch) < batch_size:
+                    length = min(block_size, size - offset)
+                    batch.append((offset, length))
+                    offset += length
+                yield batch
+
+        def blocks():
+            # `readv` only sends the read requests once we ask for the first
+            # block, so we do that for the next batch before handing out the
+            # rest of the current one.
+            current = None
+            for batch in batches():
+                reads = remote.readv(batch)
+                first = next(reads)
+                if current is not None:
+                    for block in current:
+                        yield block
+                current = itertools.chain([first], reads)
+
+            if current is not None:
+                for block in current:
+                    yield block
+
+        downloaded = 0
+        for block in blocks():
+            if throttle is not None:
+                throttle(len(block))
+            if digest is not None:
+                digest.update(block)
+            fileobj.write(block)
+            downloaded += len(block)
+            if callback:
+                callback(start + downloaded, size)
+
+    return downloaded
+
+
+def download_command_output(sftp, command, fileobj,
+                            block_size=DEFAULT_READ_BLOCK_SIZE, throttle=None):
+    """Run a command on the remote and write its stdout to a local file
+    object, over a new channel on the same connection as the SFTP session.
+
+    Args:
+        sftp(SFTPClient)
+        command(str): The shell command to run
+        fileobj(file): Local file object to write the output to
+        block_size(int): Maximum size of each read from the channel
+        throttle(func): Called with the size of each read, and may block to
+            limit the rate of the download
+
+    Returns:
+        int: The number of bytes downloaded
+
+    Raises:
+        Exception: if the command exits with a non-zero status
+    """
+    channel = sftp.get_channel().get_transport().open_session()
+    try:
+        channel.exec_command(command)
+
+        downloaded = 0
+        while True:
+            data = channel.recv(block_size)
+            if not data:
+                break
+            if throttle is not None:
+                throttle(len(data))
+            fileobj.write(data)
+            downloaded += len(data)
+
+        status = channel.recv_exit_status()
+        if status != 0:
+            error = channel.makefile_stderr("rb").read().strip()
+            raise Exception("Command %r exited with status %d: %s" % (
+                command, status, error,
+            ))
+    finally:
+        channel.close()
+
+    return downloaded
+
+
+class PipelinedWriter(object):
+    """A file-like object that hands written data off to a background thread,
+    which writes it to the wrapped file object.
+
+    This lets e.g. a download carry on receiving data while the previous
+    blocks are being compressed, rather than the two taking turns. zlib
+    releases the GIL while compressing so the two really do run in parallel.
+    Up to `max_buffers` writes are queued before `write` blocks.
+
+    If given, `rate_observer.record_input(size, seconds)` is called with how
+    long each write took to arrive, not counting time spent waiting for room
+    in the queue, i.e. the rate at which the data is being produced.
+    """
+    def __init__(self, fileobj, max_buffers=PIPELINE_BUFFERS,
+                 rate_observer=None):
+        self.fileobj = fileobj
+        self.rate_observer = rate_observer
+        self._queue = Queue(max_buffers)
+        self._error = None
+        self._closed = False
+        self._last_write = time.time()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+
+            # If writing failed we keep draining the queue, so that the
+            # writer doesn't block forever, until we get to `write` or `close`
+            # to raise the error.
+            if self._error is None:
+                try:
+                    self.fileobj.write(data)
+                except Exception as e:
+                    self._error = e
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+
+        if self.rate_observer is not None:
+            self.rate_observer.record_input(
+                len(data), time.time() - self._last_write,
+            )
+
+        self._queue.put(data)
+        self._last_write = time.time()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            if self._error is not None:
+                raise self._error
+        finally:
+            self.fileobj.close()
+
+    def abort(self):
+        """Stop writing without finishing off the wrapped file object, e.g.
+        because the download failed. The wrapped file object is aborted if it
+        supports that, and closed otherwise.
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        self._queue.put(None)
+        self._thread.join()
+        getattr(self.fileobj, "abort", self.fileobj.close)()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _deflate_block(block, level):
+    """Compress a block as raw deflate data that can be concatenated with
+    other blocks, i.e. ending with a sync flush rather than a final block.
+
+    Returns:
+        (str, float): The compressed data and the time it finished being
+        compressed
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data, time.time()
+
+
+class AdaptiveLevel(object):
+    """Picks the compression level to use for each block of a file, aiming
+    for the highest level at which compressing keeps up with the download.
+
+    The rate data arrives at is measured by `PipelinedWriter`, and the rate
+    at which each level compresses by `BlockGzipWriter`. The compression rate
+    is the throughput the file actually gets, so it accounts for sharing the
+    compression threads with other files. If the current level
+    can't keep up we drop a level, and if it has plenty of headroom (or the
+    next level up has been seen to keep up) we try the next level up.
+
+    Attributes:
+        level(int): The level to compress the next block at
+        levels_used(Counter): Number of input bytes compressed at each level
+    """
+    MIN_LEVEL = 1
+    MAX_LEVEL = 9
+
+    # Weight given to each new measurement in the moving averages
+    SMOOTHING = 0.3
+
+    # How much faster than the input the current level has to be before we
+    # try a level we haven't measured yet
+    HEADROOM = 1.5
+
+    def __init__(self, level=6):
+        """
+        Args:
+            level(int): Level to start at
+        """
+        self.level = level
+        self.levels_used = Counter()
+
+        self._input_rate = None
+        self._compress_rates = {}
+        self._lock = threading.Lock()
+
+    def _average(self, current, value):
+        if current is None:
+            return value
+        return current + self.SMOOTHING * (value - current)
+
+    def record_input(self, size, seconds):
+        """Record that `size` bytes took `seconds` to arrive
+        """
+        if seconds <= 0:
+            return
+        with self._lock:
+            self._input_rate = self._average(self._input_rate, size / seconds)
+
+    def record_compressed(self, level, size, seconds):
+        """Record that `size` bytes took `seconds` to compress at `level`,
+        and pick the level for the next block.
+        """
+        with self._lock:
+            self.levels_used[level] += size
+            if seconds > 0:
+                self._compress_rates[level] = self._average(
+                    self._compress_rates.get(level), size / seconds,
+                )
+            self._adjust()
+
+    def _adjust(self):
+        if self._input_rate is None:
+            return
+
+        current = self._compress_rates.get(self.level)
+        if current is None:
+            return
+
+        if current < self._input_rate:
+            self.level = max(self.level - 1, self.MIN_LEVEL)
+        elif self.level < self.MAX_LEVEL:
+            higher = self._compress_rates.get(self.level + 1)
+            if higher is None:
+                if current > self.HEADROOM * self._input_rate:
+                    self.level += 1
+            elif higher >= self._input_rate:
+                self.level += 1
+
+
+class BlockGzipWriter(object):
+    """A write-only file object that gzips data written to it a block at a
+    time, optionally compressing blocks concurrently on a thread pool (like
+    pigz) and optionally choosing the level of each block adaptively.
+
+    Each block is deflated independently and the results are concatenated
+    into a single gzip member, with the CRC and length in the trailer
+    computed over the whole input, so the output decompresses with a standard
+    `gzip -d`.
+
+    The wrapped file object is closed when the writer is closed.
+    """
+    def __init__(self, fileobj, compresslevel, pool=None, threads=1,
+                 block_size=COMPRESS_BLOCK_SIZE, adaptive=None):
+        """
+        Args:
+            fileobj(file): File object to write the gzip stream to
+            compresslevel(int)
+            pool(ThreadPool|None): Pool to compress blocks on. If None blocks
+                are compressed in the calling thread.
+            threads(int): Number of threads in the pool, used to limit how
+                many blocks are queued up at once
+            block_size(int): Size of the blocks input is split into
+            adaptive(AdaptiveLevel|None): If given, picks the level of each
+                block instead of `compresslevel`
+        """
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.pool = pool
+        self.block_size = block_size
+        self.adaptive = adaptive
+
+        self._max_pending = 2 * threads
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+        self._crc = zlib.crc32("")
+        self._size = 0
+
+        # When the last block we wrote finished being compressed
+        self._last_finished = 0
+        self._closed = False
+
+        if adaptive is not None:
+            xfl = 0
+        elif compresslevel == 9:
+            xfl = 2
+        elif compresslevel == 1:
+            xfl = 4
+        else:
+            xfl = 0
+
+        # ID1, ID2, CM=deflate, FLG=0, MTIME, XFL, OS=unknown
+        self.fileobj.write(struct.pack(
+            "<BBBBIBB", 0x1f, 0x8b, 8, 0, int(time.time()), xfl, 255,
+        ))
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        block = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        level = self.compresslevel
+        if self.adaptive is not None:
+            level = self.adaptive.level
+
+        submitted = time.time()
+        if self.pool is None:
+            self._write_block(
+                level, len(block), submitted, _deflate_block(block, level),
+            )
+            return
+
+        self._pending.append((
+            level, len(block), submitted,
+            self.pool.apply_async(_deflate_block, (block, level)),
+        ))
+
+        # Write out finished blocks in order, waiting for the oldest if too
+        # many are queued up.
+        while self._pending and (
+            len(self._pending) > self._max_pending or
+            self._pending[0][3].ready()
+        ):
+            self._write_pending()
+
+    def _write_pending(self):
+        level, size, submitted, result = self._pending.popleft()
+        self._write_block(level, size, submitted, result.get())
+
+    def _write_block(self, level, size, submitted, result):
+        data, finished = result
+
+        # The time the block took is from when it was submitted, or when the
+        # previous block finished if that was later, so that it includes any
+        # time spent waiting for a thread in the pool (which may be busy with
+        # other files) but not time spent waiting for input.
+        seconds = finished - max(submitted, self._last_finished)
+        self._last_finished = max(self._last_finished, finished)
+
+        if self.adaptive is not None:
+            self.adaptive.record_compressed(level, size, seconds)
+        self.fileobj.write(data)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            if self._buffer:
+                self._submit()
+            while self._pending:
+                self._write_pending()
+
+            # An empty final block ends the deflate stream
+            final = zlib.compressobj(
+                self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS,
+            )
+            self.fileobj.write(final.flush())
+
+            self.fileobj.write(struct.pack(
+                "<II", self._crc & 0xffffffff, self._size & 0xffffffff,
+            ))
+        finally:
+            self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class _ClosingWriter(object):
+    """Wraps a compressing writer so that closing it also closes the file
+    object it writes to.
+    """
+    def __init__(self, writer, fileobj, finish=None):
+        """
+        Args:
+            writer: The compressing file-like object
+            fileobj(file): The file object `writer` writes to
+            finish(func): Called instead of `writer.close()` to end the
+                compressed stream, for writers whose `close` doesn't do that
+        """
+        self.writer = writer
+        self.fileobj = fileobj
+        self.finish = finish or writer.close
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        try:
+            self.finish()
+        finally:
+            self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class _UnclosableFile(object):
+    """Proxies a file object, except that closing it does nothing
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def close(self):
+        pass
+
+
+class CheckpointingWriter(object):
+    """A write-only file object that compresses data as a series of
+    independently compressed members, recording a checkpoint after each, so
+    that an interrupted download can be resumed from the last checkpoint.
+
+    gzip, zstd, xz and lz4 all decompress concatenated members as if they
+    were a single stream.
+
+    The checkpoint is written next to the file with a ".resume" suffix, and
+    holds how many uncompressed bytes had been written and the size of the
+    file at that point. It is removed when the writer is closed.
+    """
+    def __init__(self, file_name, open_member, offset=0,
+                 interval=RESUME_CHECKPOINT_SIZE):
+        """
+        Args:
+            file_name(str): File to append the compressed members to
+            open_member(func): Takes a file object and returns a compressing
+                writer that writes a member to it
+            offset(int): Number of uncompressed bytes already in the file
+            interval(int): Number of uncompressed bytes to write between
+                checkpoints
+        """
+        self.file_name = file_name
+        self.checkpoint_name = file_name + ".resume"
+        self.open_member = open_member
+        self.offset = offset
+        self.interval = interval
+
+        self.fileobj = open(file_name, 'ab')
+        self._member = open_member(_UnclosableFile(self.fileobj))
+        self._member_size = 0
+        self._closed = False
+
+    def write(self, data):
+        self._member.write(data)
+        self._member_size += len(data)
+        if self._member_size >= self.interval:
+            self._checkpoint()
+            self._member = self.open_member(_UnclosableFile(self.fileobj))
+
+    def _checkpoint(self):
+        self._member.close()
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+
+        self.offset += self._member_size
+        self._member_size = 0
+
+        tmp_name = self.checkpoint_name + ".tmp"
+        with open(tmp_name, 'w') as f:
+            f.write("%d %d\n" % (
+                self.offset, os.fstat(self.fileobj.fileno()).st_size,
+            ))
+        os.rename(tmp_name, self.checkpoint_name)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            self._member.close()
+        finally:
+            self.fileobj.close()
+
+        if os.path.exists(self.checkpoint_name):
+            os.remove(self.checkpoint_name)
+
+    def abort(self):
+        """Close the file, leaving the last checkpoint in place. Anything
+        written after the checkpoint is discarded when resuming.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self.fileobj.close()
+
+
+def read_checkpoint(file_name):
+    """Read the checkpoint left by a CheckpointingWriter for the given file
+
+    Returns:
+        (int, int)|None: The number of uncompressed bytes written and the size
+        of the file at the checkpoint, or None if there is no valid checkpoint
+    """
+    try:
+        with open(file_name + ".resume") as f:
+            offset, size = [int(x) for x in f.read().split()]
+    except (IOError, ValueError):
+        return None
+    return offset, size
+
+
+class Codec(object):
+    """A compression format that files can be archived in.
+
+    Attributes:
+        name(str): Name used to select the codec in the config
+        extension(str): Extension added to files compressed with this codec
+        default_level(int): Compression level used if none is configured
+        module: The module implementing the codec, or None if it isn't
+            installed
+        package(str): The package to install to make the codec available
+    """
+    name = None
+    extension = None
+    default_level = None
+    module = None
+    package = None
+
+    def remote_command(self, file_name, level):
+        """The shell command to run on the remote to write the file compressed
+        with this codec to stdout.
+        """
+        return "%s -c -%d < %s" % (
+            self.name, level, pipes.quote(file_name),
+        )
+
+    def open(self, fileobj, level, threads=1, pool=None):
+        """Wrap a file object opened for writing with a compressing writer,
+        which closes the file object when closed.
+
+        Args:
+            fileobj(file)
+            level(int): Compression level
+            threads(int): Number of threads to compress with, where the
+                codec supports it
+            pool(ThreadPool|None): A pool of `threads` threads that can be
+                used to compress
+
+        Returns:
+            A write-only file-like object
+        """
+        raise NotImplementedError()
+
+    def open_reader(self, fileobj):
+        """Wrap a file object of data compressed with this codec with a
+        reader that decompresses it, treating concatenated members as one
+        stream.
+
+        Returns:
+            A read-only file-like object
+        """
+        raise NotImplementedError()
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+    extension = ".gz"
+    default_level = 9
+    module = gzip
+
+    def open(self, fileobj, level, threads=1, pool=None):
+        if pool is not None and threads > 1:
+            return BlockGzipWriter(fileobj, level, pool, threads)
+
+        return _ClosingWriter(
+            gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level),
+            fileobj,
+        )
+
+    def open_reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    extension = ".zst"
+    default_level = 3
+    module = zstandard
+    package = "zstandard"
+
+    def open(self, fileobj, level, threads=1, pool=None):
+        # zstd has its own support for compressing with multiple threads
+        compressor = zstandard.ZstdCompressor(
+            level=level, threads=threads if threads > 1 else 0,
+        )
+        writer = compressor.stream_writer(fileobj)
+        return _ClosingWriter(
+            writer, fileobj,
+            finish=lambda: writer.flush(zstandard.FLUSH_FRAME),
+        )
+
+    def open_reader(self, fileobj):
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True,
+        )
+
+
+class XzCodec(Codec):
+    name = "xz"
+    extension = ".xz"
+    default_level = 6
+    module = lzma
+    package = "backports.lzma"
+
+    def open(self, fileobj, level, threads=1, pool=None):
+        return _ClosingWriter(
+            lzma.LZMAFile(fileobj, mode='wb', preset=level), fileobj,
+        )
+
+    def open_reader(self, fileobj):
+        return lzma.LZMAFile(fileobj, mode='rb')
+
+
+class Lz4Codec(Codec):
+    name = "lz4"
+    extension = ".lz4"
+    default_level = 0
+    module = lz4
+    package = "lz4"
+
+    def open(self, fileobj, level, threads=1, pool=None):
+        return _ClosingWriter(
+            lz4.frame.LZ4FrameFile(
+                fileobj, mode='wb', compression_level=level,
+            ),
+            fileobj,
+        )
+
+    def open_reader(self, fileobj):
+        return lz4.frame.LZ4FrameFile(fileobj, mode='rb')
+
+
+CODECS = {
+    codec.name: codec
+    for codec in (GzipCodec(), ZstdCodec(), XzCodec(), Lz4Codec())
+}
+
+
+def get_codec(name, local=True):
+    """Look up a codec by name, checking that it is available.
+
+    Args:
+        name(str)
+        local(bool): Whether the codec will be used locally, rather than only
+            on the remote, and so needs to be installed
+
+    Raises:
+        ValueError: if the codec is unknown or its module isn't installed
+    """
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError("Unknown compression codec %r" % (name,))
+    if local and codec.module is None:
+        raise ValueError("Compression codec %r requires the %s package" % (
+            name, codec.package,
+        ))
+    return codec
+
+
+def find_names_expression(globs):
+    """Build the `find` expression to match file names against any of the
+    globs
+    """
+    names = " -o ".join('-name "%s"' % (glob,) for glob in globs)
+    if len(globs) > 1:
+        names = "\\( %s \\)" % (names,)
+    return names
+
+
+def list_remote_files_sftp(sftp, directory, globs):
+    """Recursively find files in a remote directory whose names match any of
+    the globs, over SFTP.
+
+    Returns:
+        list(RemoteFile): The inodes are always None, as SFTP doesn't tell us
+    """
+    files = []
+    directories = [directory]
+    while directories:
+        current = directories.pop()
+        for attrs in sftp.listdir_attr(current):
+            path = posixpath.join(current, attrs.filename)
+            if stat.S_ISDIR(attrs.st_mode):
+                directories.append(path)
+            if any(
+                fnmatch.fnmatchcase(attrs.filename, glob) for glob in globs
+            ):
+                files.append(RemoteFile(
+                    path=path,
+                    size=attrs.st_size,
+                    mtime=attrs.st_mtime,
+                    inode=None,
+                ))
+    return files
+
+
+def segment_name(pending_name, index):
+    """The file a segment of a segmented download is written to
+    """
+    return "%s.%d" % (pending_name, index)
+
+
+def remove_segments(pending_name):
+    """Remove any segments left behind by an interrupted segmented download.
+
+    Segments are numbered from zero and removed from the last one back, so
+    any that are left over are always the first few.
+    """
+    index = 0
+    while os.path.exists(segment_name(pending_name, index)):
+        os.remove(segment_name(pending_name, index))
+        index += 1
+
+
+def remove_partial(pending_name):
+    """Remove a partial download, along with any checkpoint or segments for
+    it
+    """
+    for name in (pending_name, pending_name + ".resume"):
+        if os.path.exists(name):
+            os.remove(name)
+    remove_segments(pending_name)
+
+
+def hash_file(file_name, digest, codec=None,
+              block_size=DEFAULT_READ_BLOCK_SIZE):
+    """Update a hashlib object with the contents of a local file
+
+    Args:
+        file_name(str)
+        digest: The hashlib object
+        codec(Codec|None): If given, the file is decompressed with the codec
+            and the decompressed contents are hashed
+        block_size(int)
+    """
+    if codec is not None and codec.module is None:
+        raise Exception(
+            "Can't checksum %s without the %s package" % (
+                file_name, codec.package,
+            )
+        )
+
+    with open(file_name, 'rb') as f:
+        reader = codec.open_reader(f) if codec is not None else f
+        for block in iter(lambda: reader.read(block_size), ""):
+            digest.update(block)
+
+
+def remote_checksum(sftp, remote_path):
+    """Get the hex SHA-256 of a file on the remote, by running `sha256sum`
+    there.
+    """
+    output = StringIO()
+    download_command_output(
+        sftp, "sha256sum < %s" % (pipes.quote(remote_path),), output,
+    )
+    return output.getvalue().split()[0]
+
+
+class RemoteRemover(object):
+    """Removes files from the remote in batches, running `rm` on the remote
+    for each batch rather than making a round trip per file. If that fails
+    (e.g. because the remote only allows SFTP) the files are removed one at a
+    time over SFTP.
+
+    Files are only removed once they've been added (and so only once they've
+    been archived), and any left over have to be removed with `flush`.
+
+    Args:
+        batch_size(int): The most files to remove at once
+        batch_bytes(int): The most bytes of paths to remove at once
+    """
+
+    def __init__(self, batch_size=REMOVE_BATCH_SIZE,
+                 batch_bytes=REMOVE_BATCH_BYTES):
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+
+        self._lock = threading.Lock()
+        self._paths = []
+        self._bytes = 0
+
+    def add(self, sftp, remote_path):
+        """Queue a file for removal, removing the current batch if it's full
+
+        Args:
+            sftp(SFTPClient): The channel to use if the batch is removed
+            remote_path(str)
+        """
+        with self._lock:
+            self._paths.append(remote_path)
+            self._bytes += len(remote_path) + 1
+            if (
+                len(self._paths) < self.batch_size and
+                self._bytes < self.batch_bytes
+            ):
+                return
+            paths = self._take()
+        self._remove(sftp, paths)
+
+    def flush(self, sftp):
+        """Remove any files still queued
+        """
+        with self._lock:
+            paths = self._take()
+        if paths:
+            self._remove(sftp, paths)
+
+    def _take(self):
+        paths = self._paths
+        self._paths = []
+        self._bytes = 0
+        return paths
+
+    def _remove(self, sftp, paths):
+        command = "rm -f -- " + " ".join(pipes.quote(p) for p in paths)
+        try:
+            download_command_output(sftp, command, StringIO())
+            return
+        except Exception:
+            pass
+
+        for remote_path in paths:
+            try:
+                sftp.remove(remote_path)
+            except IOError as e:
+                # It may have been removed by the `rm` before that failed
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def ensure_dir(path):
+    """Create a directory, and any parents, if it doesn't already exist
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+class Layout(object):
+    """Where archived files go in the archive directory, given by a template
+    such as `{service}/{host}/{yyyy}/{mm}/{file}`. The fields are:
+
+        service, host: The service and host the file was archived from
+        yyyy, mm, dd: The date in the name of the file
+        file: The name of the file
+
+    The template has to start with directories for the service and host, and
+    end with `{file}`.
+
+    If the directories after those for the service and host are `{yyyy}`,
+    `{yyyy}/{mm}` or `{yyyy}/{mm}/{dd}` then retention can delete whole
+    directories of expired files at once, see `Layout.expired`.
+    """
+
+    DATE_FIELDS = ("yyyy", "mm", "dd")
+    FIELDS = ("service", "host", "file") + DATE_FIELDS
+
+    def __init__(self, template=DEFAULT_LAYOUT):
+        self.template = template
+
+        parts = template.split("/")
+        fields = [
+            [f for _, f, _, _ in string.Formatter().parse(part) if f]
+            for part in parts
+        ]
+
+        for part_fields in fields:
+            for field in part_fields:
+                if field not in self.FIELDS:
+                    raise ValueError(
+                        "Unknown field %r in layout %r" % (field, template)
+                    )
+
+        if parts[-1] != "{file}" or "file" in sum(fields[:-1], []):
+            raise ValueError(
+                "Layout %r must end with {file}, and only there" % (template,)
+            )
+
+        # The directory for the service and host is every directory up to
+        # the first one with a date in it.
+        root_len = len(parts) - 1
+        for i, part_fields in enumerate(fields[:-1]):
+            if set(part_fields) & set(self.DATE_FIELDS):
+                root_len = i
+                break
+        root_fields = sum(fields[:root_len], [])
+        if "service" not in root_fields or "host" not in root_fields:
+            raise ValueError(
+                "Layout %r must start with directories for the {service} and"
+                " {host}" % (template,)
+            )
+
+        self._root = "/".join(parts[:root_len])
+        self._needs_date = bool(
+            set(sum(fields, [])) & set(self.DATE_FIELDS)
+        )
+
+        # The date fields of each directory under the root, if they are just
+        # one of those in turn.
+        date_dirs = tuple(parts[root_len:-1])
+        self.date_fields = None
+        if date_dirs == tuple(
+            "{%s}" % (f,) for f in self.DATE_FIELDS[:len(date_dirs)]
+        ):
+            self.date_fields = self.DATE_FIELDS[:len(date_dirs)]
+
+    def root(self, service, host):
+        """The directory, relative to the archive directory, under which all
+        the files for the service and host go
+        """
+        return os.path.join(*self._root.format(
+            service=service, host=host,
+        ).split("/"))
+
+    def path(self, service, host, file_name):
+        """The path, relative to the archive directory, to archive the file
+        to.
+
+        Args:
+            service(str)
+            host(str)
+            file_name(str): The name of the file, i.e. without any directory
+
+        Returns:
+            str|None: None if the layout needs a date but the file doesn't
+            have one
+        """
+        fields = {}
+        m = DATE_REGEX.search(file_name)
+        if m:
+            fields = dict(zip(self.DATE_FIELDS, m.groups()))
+        elif self._needs_date:
+            return None
+
+        return os.path.join(*self.template.format(
+            service=service, host=host, file=file_name, **fields
+        ).split("/"))
+
+    def expired(self, root_dir, before):
+        """Find the directories and files under the directory for a service
+        and host whose dates are before the given date. Only the directories
+        that might contain a mix of expired and unexpired files are listed.
+
+        Only works when `date_fields` is set.
+
+        Args:
+            root_dir(str): The directory for the service and host
+            before(date)
+
+        Returns:
+            tuple(list(str), list(str)): The directories and the files that
+            have expired, oldest first
+        """
+        cutoff = (before.year, before.month, before.day)
+        before_key = int(before.strftime("%Y%m%d"))
+        dirs = []
+        files = []
+
+        def visit(path, depth, prefix):
+            try:
+                names = sorted(os.listdir(path))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    return
+                raise
+
+            if depth == len(self.date_fields):
+                for name in names:
+                    key = date_key(name)
+                    if key is not None and key < before_key:
+                        files.append((key, os.path.join(path, name)))
+                return
+
+            for name in names:
+                if not name.isdigit():
+                    continue
+                value = prefix + (int(name),)
+                sub_path = os.path.join(path, name)
+                if not os.path.isdir(sub_path):
+                    continue
+                if value < cutoff[:depth + 1]:
+                    dirs.append(sub_path)
+                elif value == cutoff[:depth + 1]:
+                    visit(sub_path, depth + 1, value)
+
+        visit(root_dir, 0, ())
+        return dirs, [f for _, f in sorted(files)]
+
+
+class StateDB(object):
+    """A record of every file that has been archived, kept in a local SQLite
+    database, so we can tell whether a file has already been archived without
+    going to the filesystem.
+
+    Safe to be used from multiple threads.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS archived_files (
+            service TEXT NOT NULL,
+            host TEXT NOT NULL,
+            remote_path TEXT NOT NULL,
+            size INTEGER,
+            mtime INTEGER,
+            checksum TEXT,
+            local_path TEXT NOT NULL,
+            codec TEXT,
+            file_date INTEGER,
+            archived_at INTEGER NOT NULL,
+            PRIMARY KEY (service, host, remote_path)
+        );
+
+        CREATE INDEX IF NOT EXISTS archived_files_date
+            ON archived_files (service, host, file_date);
+
+        CREATE INDEX IF NOT EXISTS archived_files_local_path
+            ON archived_files (local_path);
+
+        -- Every dated file in the archive directory of each service and
+        -- host, so that retention can find expired files without walking
+        -- the whole directory.
+        CREATE TABLE IF NOT EXISTS local_files (
+            local_path TEXT NOT NULL PRIMARY KEY,
+            service TEXT NOT NULL,
+            host TEXT NOT NULL,
+            file_date INTEGER NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS local_files_date
+            ON local_files (service, host, file_date);
+
+        -- The services and hosts whose existing archive directories have
+        -- been added to local_files.
+        CREATE TABLE IF NOT EXISTS indexed_dirs (
+            service TEXT NOT NULL,
+            host TEXT NOT NULL,
+            PRIMARY KEY (service, host)
+        );
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path(str): Path of the SQLite database, which is created if it
+                doesn't exist
+        """
+        self.path = path
+
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(self.SCHEMA)
+
+    def is_archived(self, service, host, remote_path):
+        """Whether the given remote file has already been archived
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM archived_files"
+                " WHERE service = ? AND host = ? AND remote_path = ?",
+                (service, host, remote_path),
+            ).fetchone()
+        return row is not None
+
+    def record(self, service, host, remote_path, size, mtime, checksum,
+               local_path, codec):
+        """Record that a remote file has been archived
+
+        Args:
+            service(str)
+            host(str)
+            remote_path(str)
+            size(int|None): Size of the remote file
+            mtime(int|None): Last modified time of the remote file
+            checksum(str|None): Hex SHA-256 of the contents of the remote file
+            local_path(str): Where the file was archived to
+            codec(str|None): Codec the file was compressed with, or None if
+                it was archived as is
+        """
+        file_date = date_key(os.path.basename(remote_path))
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO archived_files ("
+                    " service, host, remote_path, size, mtime, checksum,"
+                    " local_path, codec, file_date, archived_at"
+                    ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        service, host, remote_path, size, mtime, checksum,
+                        local_path, codec, file_date, int(time.time()),
+                    ),
+                )
+                if file_date is not None:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO local_files ("
+                        " local_path, service, host, file_date"
+                        ") VALUES (?, ?, ?, ?)",
+                        (local_path, service, host, file_date),
+                    )
+
+    def index_local_files(self, service, host, base_dir):
+        """Add the files already in the archive directory for the service and
+        host to the index of local files, if that hasn't been done yet. After
+        this, files are added to the index as they are archived.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM indexed_dirs WHERE service = ? AND host = ?",
+                (service, host),
+            ).fetchone()
+        if row is not None:
+            return
+
+        rows = []
+        for dirpath, _, filenames in walk(base_dir):
+            for filename in filenames:
+                file_date = date_key(filename)
+                if file_date is not None:
+                    rows.append((
+                        os.path.join(dirpath, filename), service, host,
+                        file_date,
+                    ))
+
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO local_files ("
+                    " local_path, service, host, file_date"
+                    ") VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.execute(
+                    "INSERT INTO indexed_dirs (service, host) VALUES (?, ?)",
+                    (service, host),
+                )
+
+    def expired_local_files(self, service, host, before):
+        """Get the local files for the service and host dated before the
+        given date.
+
+        Args:
+            service(str)
+            host(str)
+            before(int): The date as an integer, e.g. 20170131
+
+        Returns:
+            list(str): Paths of the files, oldest first
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT local_path FROM local_files"
+                " WHERE service = ? AND host = ? AND file_date < ?"
+                " ORDER BY file_date, local_path",
+                (service, host, before),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def forget_local_file(self, local_path):
+        """Remove a local file from the index, e.g. once it has been deleted
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM local_files WHERE local_path = ?",
+                    (local_path,),
+                )
+
+    def forget_local_dir(self, path):
+        """Remove all the local files under a directory from the index, e.g.
+        once the directory has been deleted
+        """
+        # Everything starting with `path/`, i.e. up to but not including
+        # `path0`, as "0" comes straight after "/". This can use the index,
+        # unlike LIKE.
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM local_files"
+                    " WHERE local_path >= ? AND local_path < ?",
+                    (path + "/", path + "0"),
+                )
+
+    def move_local_file(self, old_path, new_path):
+        """Record that an archived file has been moved
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "UPDATE archived_files SET local_path = ?"
+                    " WHERE local_path = ?",
+                    (new_path, old_path),
+                )
+                self._conn.execute(
+                    "UPDATE local_files SET local_path = ?"
+                    " WHERE local_path = ?",
+                    (new_path, old_path),
+                )
+
+    def newest_archived_date(self, service, host):
+        """The newest date of the files archived for the service and host
+
+        Returns:
+            int|None: The date as an integer, e.g. 20170131, or None if no
+            files with dates have been archived
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MAX(file_date) FROM archived_files"
+                " WHERE service = ? AND host = ?",
+                (service, host),
+            ).fetchone()
+        return row[0]
+
+    def recent_bytes(self, service, host, days=7):
+        """How many bytes of remote files have been archived for the service
+        and host in the last `days` days, as an estimate of how big a run
+        for it is going to be.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT SUM(size) FROM archived_files"
+                " WHERE service = ? AND host = ? AND archived_at >= ?",
+                (service, host, int(time.time()) - days * 24 * 60 * 60),
+            ).fetchone()
+        return row[0] or 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Connection(object):
+    """An SSH connection to a remote host along with an SFTP session over it
+    """
+    def __init__(self, client):
+        self.client = client
+        self.sftp = client.open_sftp()
+        self._extra_channels = []
+        self._find_supports_printf = None
+
+    def sftp_channels(self, count):
+        """Get `count` SFTP channels over this connection, opening new ones
+        multiplexed over the same transport as needed and closing any more
+        than that left over from before. The first channel is always
+        `self.sftp`.
+
+        Returns:
+            list(SFTPClient)
+        """
+        count = max(count, 1)
+        while len(self._extra_channels) < count - 1:
+            self._extra_channels.append(self.client.open_sftp())
+        while len(self._extra_channels) > count - 1:
+            self._extra_channels.pop().close()
+        return [self.sftp] + self._extra_channels
+
+    def find_supports_printf(self):
+        """Whether we can list files with `find -printf` on the remote. This
+        is checked the first time it's needed, and remembered.
+        """
+        if self._find_supports_printf is None:
+            try:
+                _, stdout, _ = self.client.exec_command(FIND_PRINTF_PROBE)
+                stdout.read()
+                supported = stdout.channel.recv_exit_status() == 0
+            except SSHException:
+                # e.g. the account is only allowed to use SFTP
+                supported = False
+            self._find_supports_printf = supported
+        return self._find_supports_printf
+
+    def is_active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        for sftp in self._extra_channels:
+            sftp.close()
+        self.sftp.close()
+        self.client.close()
+
+
+class ConnectionPool(object):
+    """Keeps a single Connection open per (host, account) so that it can be
+    reused by all the services on that host for the duration of a run.
+
+    Connections handed out are not safe to be used by more than one thread at
+    a time, so callers should make sure that services on the same host and
+    account are handled serially.
+    """
+    def __init__(self, use_ssh_agent):
+        """
+        Args:
+            use_ssh_agent(bool): Allow SSH client to try keys in SSH agent
+        """
+        self.use_ssh_agent = use_ssh_agent
+        self._connections = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, account):
+        """Get the connection for the given host and account, connecting if
+        there isn't already an active one.
+
+        Returns:
+            Connection
+        """
+        key = (host, account)
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+
+        # We only hold the lock for this key while connecting so that we
+        # don't block connecting to other hosts.
+        with key_lock:
+            conn = self._connections.get(key)
+            if conn is not None and conn.is_active():
+                return conn
+
+            client = SSHClient()
+            # TODO: Use something other than auto add policy?
+            client.set_missing_host_key_policy(AutoAddPolicy())
+            client.connect(
+                host,
+                username=account,
+                compress=True,
+                allow_agent=self.use_ssh_agent,
+            )
+
+            conn = Connection(client)
+            self._connections[key] = conn
+            return conn
+
+    def discard(self, host, account):
+        """Close and forget the connection for the given host and account, if
+        any, e.g. because it may have been left in a bad state.
+        """
+        conn = self._connections.pop((host, account), None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        """Close all connections in the pool
+        """
+        for key in list(self._connections):
+            self.discard(*key)
+
+
+def parse_rate(value):
+    """Parse a rate in bytes per second, which may have a K, M or G suffix,
+    e.g. "10M".
+
+    Returns:
+        int
+    """
+    m = RATE_REGEX.match(str(value).strip())
+    if not m:
+        raise ValueError("Invalid rate %r" % (value,))
+    number, suffix = m.groups()
+    return int(float(number) * RATE_SUFFIXES[suffix.upper()])
+
+
+def parse_time_of_day(value):
+    """Parse a "HH:MM" time of day into minutes since midnight
+    """
+    # YAML reads unquoted times like 09:00 as base 60 integers, which
+    # happens to be exactly the number of minutes we want.
+    if isinstance(value, int):
+        return value
+    hours, minutes = str(value).split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+class RateSchedule(object):
+    """A bandwidth limit that can vary with the time of day.
+
+    Made up of a list of rules, each with a rate and optionally the time of
+    day it applies from and to. The first rule that applies at a given time
+    is used, and if none do there is no limit.
+    """
+    def __init__(self, rules):
+        """
+        Args:
+            rules(list((int|None, int|None, int|None))): The minute of the
+                day each rule starts and ends at (None for all day) and the
+                rate in bytes per second (None for unlimited)
+        """
+        self.rules = rules
+
+    @classmethod
+    def from_config(cls, value):
+        """Parse a bandwidth limit from the config, which is either a rate
+        or a list of rules like `{from: "09:00", to: "18:00", rate: 2M}`.
+
+        Returns:
+            RateSchedule|None: None if `value` is None
+        """
+        if value is None:
+            return None
+        if not isinstance(value, list):
+            return cls([(None, None, parse_rate(value))])
+
+        rules = []
+        for rule in value:
+            start = end = None
+            if "from" in rule or "to" in rule:
+                start = parse_time_of_day(rule.get("from", "00:00"))
+                end = parse_time_of_day(rule.get("to", "24:00"))
+            rate = rule.get("rate")
+            rules.append((
+                start, end, parse_rate(rate) if rate is not None else None,
+            ))
+        return cls(rules)
+
+    def rate(self, now=None):
+        """The rate limit at the given time (defaults to now)
+
+        Returns:
+            int|None: Bytes per second, or None if unlimited
+        """
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.rules:
+            if start is None:
+                return rate
+            if start <= end and start <= minute < end:
+                return rate
+            # Rules can wrap around midnight, e.g. from 22:00 to 06:00
+            if start > end and (minute >= start or minute < end):
+                return rate
+        return None
+
+
+class TokenBucket(object):
+    """Limits the rate at which bytes are consumed, following a RateSchedule.
+
+    Safe to be shared between threads, which get a fair share of the rate
+    between them.
+    """
+    def __init__(self, schedule, burst_seconds=1.0):
+        """
+        Args:
+            schedule(RateSchedule)
+            burst_seconds(float): How many seconds worth of bytes can be
+                consumed in one go after the bucket has been idle
+        """
+        self.schedule = schedule
+        self.burst_seconds = burst_seconds
+        self._tokens = 0.0
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        """Take `size` bytes from the bucket, sleeping if that puts it over
+        the current rate. A rate of zero pauses downloads until the rate
+        changes.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                rate = self.schedule.rate()
+                if rate is None:
+                    self._tokens = 0.0
+                    self._last = now
+                    return
+
+                if rate > 0:
+                    capacity = rate * self.burst_seconds
+                    self._tokens = min(
+                        capacity, self._tokens + (now - self._last) * rate,
+                    )
+                    self._last = now
+
+                    # We let the bucket go into debt and then sleep the debt
+                    # off, so blocks bigger than the bucket still get through.
+                    self._tokens -= size
+                    delay = -self._tokens / rate if self._tokens < 0 else 0
+                    break
+
+                # Paused, so nothing builds up in the bucket meanwhile
+                self._tokens = 0.0
+                self._last = now
+
+            time.sleep(RATE_PAUSE_CHECK_SECONDS)
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _NoLimit(object):
+    """Stands in for a semaphore when there is no limit
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def acquire(self, blocking=True):
+        return True
+
+    def release(self):
+        pass
+
+
+class ArchiveStats(object):
+    """Statistics about archiving a service, for the summary at the end of
+    the run.
+
+    Attributes:
+        files(int): Number of files archived
+        bytes(int): Number of bytes downloaded
+        compression_levels(Counter): Number of bytes compressed at each level,
+            for files whose level was picked adaptively
+    """
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.compression_levels = Counter()
+        self._lock = threading.Lock()
+
+    def add_file(self, size, adaptive=None):
+        """Record that a file was archived
+
+        Args:
+            size(int): Number of bytes downloaded
+            adaptive(AdaptiveLevel|None): The level picker used for the file,
+                if any
+        """
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            if adaptive is not None:
+                self.compression_levels.update(adaptive.levels_used)
+
+    def describe_levels(self):
+        """Describe how much data was compressed at each adaptive level, e.g.
+        "6 (80%), 7 (20%)"
+        """
+        total = sum(self.compression_levels.values())
+        return ", ".join(
+            "%d (%d%%)" % (level, 100 * size // total)
+            for level, size in sorted(self.compression_levels.items())
+        )
+
+
+class Archiver(object):
+    def __init__(self, base_dir, verbose, dry_run, remove, use_ssh_agent,
+                 show_progress=None, compress_threads=1, state_db=None,
+                 bandwidth_limit=None, host_bandwidth_limit=None,
+                 verify=False, layout=None, full_scan=False,
+                 max_transfers=None):
+        """
+        Args:
+            base_dir(str): Local base path to log files to
+            verbose(bool): Print what its doing
+            dry_run(bool): Don't actually copy files, just print
+            remove(bool): Actually remove remote files
+            use_ssh_agent(bool): Allow SSH client to try keys in SSH agent
+            show_progress(bool): Show progress bars for downloads. Defaults
+                to the value of `verbose`.
+            compress_threads(int): Number of threads to use to compress each
+                file that is compressed while downloading
+            state_db(StateDB|None): Where to record archived files, if
+                anywhere
+            bandwidth_limit(RateSchedule|None): Limit on the total rate of
+                all downloads
+            host_bandwidth_limit(RateSchedule|None): Limit on the rate of
+                downloads from each host
+            verify(bool): Check the checksum of each downloaded file against
+                the remote before accepting it (and so before removing it)
+            layout(Layout|None): Where to put files in `base_dir`. Defaults
+                to a directory per service and host.
+            full_scan(bool): Always look for every file matching each
+                service's pattern, rather than just those newer than what has
+                already been archived
+            max_transfers(int|None): Limit on how many files are downloaded
+                at once, across all hosts and services
+        """
+        self.base_dir = base_dir
+        self.verbose = verbose
+        self.dry_run = dry_run
+        self.remove = remove
+        self.use_ssh_agent = use_ssh_agent
+        if show_progress is None:
+            show_progress = verbose
+        self.show_progress = show_progress
+        self.connections = ConnectionPool(use_ssh_agent)
+        self.state_db = state_db
+        self.verify = verify
+        if layout is None:
+            layout = Layout()
+        self.layout = layout
+        self.full_scan = full_scan
+
+        self.transfer_slots = _NoLimit()
+        if max_transfers:
+            self.transfer_slots = threading.BoundedSemaphore(max_transfers)
+
+        self.bandwidth_limit = None
+        if bandwidth_limit is not None:
+            self.bandwidth_limit = TokenBucket(bandwidth_limit)
+        self.host_bandwidth_limit = host_bandwidth_limit
+
+        # Token buckets for each host and service, created as needed
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+
+        # The pool is shared by all files so the number of compression
+        # threads doesn't multiply when downloading concurrently.
+        self.compress_threads = compress_threads
+        self.compress_pool = None
+        if compress_threads > 1:
+            self.compress_pool = ThreadPool(compress_threads)
+
+    def close(self):
+        """Close any connections that were opened while archiving
+        """
+        self.connections.close()
+        if self.state_db is not None:
+            self.state_db.close()
+        if self.compress_pool is not None:
+            self.compress_pool.close()
+            self.compress_pool.join()
+
+    def _bucket(self, key, schedule):
+        with self._buckets_lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(schedule)
+            return bucket
+
+    def _throttle(self, service):
+        """Get a function that limits the rate of downloads for the service,
+        according to the global, per host and per service limits.
+
+        Returns:
+            func|None: Takes the size of each block downloaded, or None if
+            there are no limits
+        """
+        buckets = []
+        if self.bandwidth_limit is not None:
+            buckets.append(self.bandwidth_limit)
+        if self.host_bandwidth_limit is not None:
+            buckets.append(self._bucket(
+                ("host", service.host), self.host_bandwidth_limit,
+            ))
+        if service.bandwidth_limit is not None:
+            buckets.append(self._bucket(
+                ("service", service.name), service.bandwidth_limit,
+            ))
+
+        if not buckets:
+            return None
+
+        def throttle(size):
+            for bucket in buckets:
+                bucket.consume(size)
+
+        return throttle
+
+    def _open_compressed(self, service, fileobj, adaptive=None):
+        """Wrap a file object with a writer that compresses data with the
+        service's codec, using multiple threads to compress if configured to.
 
-Service = namedtuple("Service", (
-    "name", "host", "account", "directory", "pattern",
-    "days_to_keep_on_remote", "retention_period_days",
-))
+        Args:
+            service(Service)
+            fileobj(file)
+            adaptive(AdaptiveLevel|None): Picks the compression level, if the
+                service is configured to use an adaptive level
+        """
+        if adaptive is not None:
+            return BlockGzipWriter(
+                fileobj, AdaptiveLevel.MAX_LEVEL,
+                self.compress_pool, self.compress_threads, adaptive=adaptive,
+            )
 
+        return service.codec.open(
+            fileobj, service.compression_level,
+            self.compress_threads, self.compress_pool,
+        )
 
-def filter_by_age(files, comparator):
-    """Filter files based on the date in their name relative to today.
+    def _scan_globs(self, service):
+        """Work out the globs for the files to look for on the remote.
 
-    Args:
-        files (iterable(str)): filenames with a date in them
-        comparator (func): A function that takes a date.timedelta and returns
-            a bool that indicates whether to include file in the output list
+        If we have a state database we only look for the files dated between
+        a little before the newest file already archived and the newest date
+        that is old enough to archive, one glob per date. Otherwise we look
+        for everything matching the service's pattern.
 
-    Returns:
-        list(str): The filtered list of files
-    """
-    today = date.today()
-    results = []
-    for f in files:
-        m = DATE_REGEX.search(f)
-        if not m:
-            continue
-        f_date = date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        Returns:
+            list(str): Empty if there can't be anything to archive
+        """
+        full_glob = service.pattern.replace("<DATE->", "????-??-??")
+        if (
+            self.state_db is None or self.full_scan or
+            "<DATE->" not in service.pattern
+        ):
+            return [full_glob]
 
-        if comparator(today - f_date):
-            results.append((f_date, f))
+        newest = self.state_db.newest_archived_date(
+            service.name, service.host,
+        )
+        if newest is None:
+            return [full_glob]
 
-    results.sort()
-    return [f for _, f in results]
+        start = datetime.strptime(str(newest), "%Y%m%d").date() - timedelta(
+            days=SCAN_MARGIN_DAYS,
+        )
+        end = date.today() - timedelta(days=service.days_to_keep_on_remote)
+        days = (end - start).days
+        if days > MAX_SCAN_DAYS:
+            return [full_glob]
+
+        return [
+            service.pattern.replace(
+                "<DATE->", (start + timedelta(days=i)).isoformat(),
+            )
+            for i in range(days)
+        ]
 
+    def _iter_remote_files(self, conn, directory, globs,
+                           block_size=DEFAULT_READ_BLOCK_SIZE):
+        """List the files in a remote directory whose names match any of the
+        globs, as they are found.
 
-class Archiver(object):
-    def __init__(self, base_dir, verbose, dry_run, remove, use_ssh_agent):
+        Uses `find -printf` to get everything in one round trip, falling back
+        to walking the directory over SFTP if the remote's `find` doesn't
+        support that.
+
+        Args:
+            conn(Connection)
+            directory(str)
+            globs(list(str))
+            block_size(int): How much of the output to read at a time
+
+        Returns:
+            iterable(RemoteFile): In the order `find` finds them
         """
+        if not conn.find_supports_printf():
+            for remote_file in list_remote_files_sftp(
+                conn.sftp, directory, globs,
+            ):
+                yield remote_file
+            return
+
+        cmd = FIND_COMMAND_TEMPLATE % {
+            "dir": directory,
+            "names": find_names_expression(globs),
+        }
+        _, stdout, _ = conn.client.exec_command(cmd)
+        channel = stdout.channel
+
+        # We parse entries as soon as they arrive rather than waiting for
+        # `find` to finish, so that we can start downloading straight away.
+        # If `find` fails (e.g. the directory doesn't exist, or it can't read
+        # some subdirectory) we just use whatever it found.
+        buf = ""
+        try:
+            while True:
+                data = channel.recv(block_size)
+                if not data:
+                    break
+                entries = (buf + data).split("\0")
+                buf = entries.pop()
+                for entry in entries:
+                    size, mtime, inode, path = entry.split("\t", 3)
+                    yield RemoteFile(
+                        path=path,
+                        size=int(size),
+                        mtime=int(float(mtime)),
+                        inode=int(inode),
+                    )
+        finally:
+            channel.close()
+
+    def list_services(self, services):
+        """List the files on the remote for several services that share a
+        host, account and directory, with a single `find`.
+
         Args:
-            base_dir(str): Local base path to log files to
-            verbose(bool): Print what its doing
-            dry_run(bool): Don't actually copy files, just print
-            remove(bool): Actually remove remote files
-            use_ssh_agent(bool): Allow SSH client to try keys in SSH agent
+            services(list(Service))
+
+        Returns:
+            dict(Service, list(RemoteFile)): The files matching each
+            service's pattern
         """
-        self.base_dir = base_dir
-        self.verbose = verbose
-        self.dry_run = dry_run
-        self.remove = remove
-        self.use_ssh_agent = use_ssh_agent
+        directory = services[0].directory
+        conn = self.connections.get(services[0].host, services[0].account)
+
+        service_globs = [(s, self._scan_globs(s)) for s in services]
+        globs = list(OrderedDict.fromkeys(
+            glob for _, s_globs in service_globs for glob in s_globs
+        ))
+
+        listings = dict((s, []) for s in services)
+        if not globs:
+            return listings
+
+        for remote_file in self._iter_remote_files(
+            conn, directory, globs, services[0].read_block_size,
+        ):
+            file_name = posixpath.basename(remote_file.path)
+            for service, s_globs in service_globs:
+                if any(fnmatch.fnmatchcase(file_name, g) for g in s_globs):
+                    listings[service].append(remote_file)
+
+        return listings
+
+    def _iter_files_to_archive(self, conn, service, found, remote_files=None):
+        """List the files on the remote that are old enough to archive, as
+        they are found.
+
+        Args:
+            conn(Connection)
+            service(Service)
+            found(Counter): Updated with the number of `files` and `bytes`
+                found so far
+            remote_files(list(RemoteFile)|None): The files on the remote
+                matching the service's pattern, if they have already been
+                listed
+
+        Returns:
+            iterable(RemoteFile)
+        """
+        cutoff = (
+            date.today() - timedelta(days=service.days_to_keep_on_remote)
+        ).isoformat()
+
+        if remote_files is None:
+            globs = self._scan_globs(service)
+            remote_files = []
+            if globs:
+                remote_files = self._iter_remote_files(
+                    conn, service.directory, globs, service.read_block_size,
+                )
+
+        for remote_file in remote_files:
+            m = DATE_REGEX.search(remote_file.path)
+            if m and m.group(0) < cutoff:
+                found["files"] += 1
+                found["bytes"] += remote_file.size
+                yield remote_file
+
+    def _resume_offset(self, remote_file, pending_name, compress):
+        """Work out how far through the file a previous, interrupted, download
+        got, and truncate the partial download to match. If it can't be
+        resumed the partial download is removed.
+
+        Args:
+            remote_file(RemoteFile): The file on the remote
+            pending_name(str): Path of the partial download
+            compress(bool): Whether the file is being compressed as it is
+                downloaded
+
+        Returns:
+            int: Offset in the remote file to resume from
+        """
+        if compress:
+            # We can only pick up from the end of the last complete member
+            offset, size = read_checkpoint(pending_name) or (0, 0)
+        else:
+            offset = size = os.path.getsize(pending_name)
+
+        if offset and (
+            os.path.getsize(pending_name) < size or
+            remote_file.size < offset
+        ):
+            offset = size = 0
 
-    def archive_service(self, service):
+        if offset:
+            with open(pending_name, 'r+b') as f:
+                f.truncate(size)
+        else:
+            remove_partial(pending_name)
+
+        return offset
+
+    def archive_service(self, service, out=None, remote_files=None):
         """Actually do the archiving step for the given Service
+
+        Args:
+            service(Service): The service to archive
+            out(file): Where to write output to, defaults to stdout
+            remote_files(list(RemoteFile)|None): The files on the remote
+                matching the service's pattern, if they have already been
+                listed (see `list_services`)
+
+        Returns:
+            ArchiveStats
         """
+        if out is None:
+            out = sys.stdout
+
+        stats = ArchiveStats()
 
         # Create the base directory for this service, i.e. where we put logs.
-        base_dir = os.path.join(self.base_dir, service.name, service.host)
-        if not os.path.exists(base_dir):
-            os.makedirs(base_dir)
+        base_dir = os.path.join(
+            self.base_dir, self.layout.root(service.name, service.host),
+        )
+        ensure_dir(base_dir)
 
         if "<DATE->" not in service.pattern:
             # We ignore services that don't have a <DATE-> in their pattern
-            print "Warning:", service.name, "does not include date. Ignoring."
-
-        # Connect to remote
-        client = SSHClient()
-        # TODO: Use something other than auto add policy?
-        client.set_missing_host_key_policy(AutoAddPolicy())
-        client.connect(
-            service.host,
-            username=service.account,
-            compress=True,
-            allow_agent=self.use_ssh_agent,
-        )
+            print >>out, "Warning:", service.name, \
+                "does not include date. Ignoring."
 
-        # Fetch list of files from the remote
-        glob = service.pattern.replace("<DATE->", "????-??-??")
-        cmd = FIND_COMMAND_TEMPLATE % {
-            "dir": service.directory,
-            "glob": glob,
-        }
-        _, stdout, _ = client.exec_command(cmd)
-        files = stdout.readlines()
-        files[:] = list(f.strip() for f in files)
-        files.sort()
+        # Connect to remote, reusing any existing connection to the host
+        conn = self.connections.get(service.host, service.account)
 
-        # Filter the files to ones we want to archive
-        files = filter_by_age(
-            files,
-            lambda d: d.days > service.days_to_keep_on_remote
+        # The files to archive are fetched from the remote as we go, so that
+        # we can start on them before the remote has finished listing them.
+        found = Counter()
+        files = self._iter_files_to_archive(
+            conn, service, found, remote_files,
         )
 
         # For each file download to a pending file name (optionally gzipping)
         # and only after it has succesfully been downloaded do we optionally
-        # delete from the remote.
-        sftp = client.open_sftp()
-        for file_name in files:
-            local_name = os.path.join(base_dir, os.path.basename(file_name))
-            if not file_name.endswith(".gz"):
-                local_name += ".gz"
-            pending_name = local_name + ".download"
+        # delete from the remote, in batches. If we have more than one SFTP
+        # channel then files are downloaded concurrently, one per channel,
+        # largest first so that a big file doesn't start last and hold up the
+        # whole service. Only so many files are downloaded at once across all
+        # hosts, if limited by `max_transfers`. Each thread downloading files
+        # gets `segments` channels, so that it can split large files into
+        # segments, see `sessions_needed`.
+        channels = conn.sftp_channels(service.sftp_channels * service.segments)
+        channels = [
+            channels[i:i + service.segments]
+            for i in range(0, len(channels), service.segments)
+        ]
+        removals = RemoteRemover()
+        try:
+            if len(channels) == 1:
+                # As with concurrent downloads, a file that fails doesn't
+                # stop the rest, and the first error is raised at the end.
+                errors = []
+                for remote_file in files:
+                    try:
+                        with self.transfer_slots:
+                            self._archive_file(
+                                channels[0], service, remote_file, out,
+                                self.show_progress, stats, removals,
+                            )
+                    except Exception as e:
+                        errors.append(e)
+                        print >>out, "Failed to archive %s: %s" % (
+                            remote_file.path, e,
+                        )
+                if errors:
+                    raise errors[0]
+            else:
+                self._archive_files_concurrently(
+                    channels, service, files, out, stats, removals,
+                )
+        except Exception:
+            # Files archived before the error should still be removed, but
+            # failing to do so shouldn't hide the original error.
+            exc_info = sys.exc_info()
+            try:
+                removals.flush(conn.sftp)
+            except Exception:
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        removals.flush(conn.sftp)
 
-            if os.path.exists(pending_name):
-                os.remove(pending_name)
+        if self.verbose:
+            print >>out, "Found %d files (%d bytes) to archive" % (
+                found["files"], found["bytes"],
+            )
+
+        # We now go and delete any files that are older than the retention
+        # period, if specified. If the files are in directories by date we
+        # can delete whole directories at once, otherwise if we have a state
+        # database we can look up just the files that have expired, rather
+        # than walking the whole archive directory.
+        if service.retention_period_days:
+            cutoff = date.today() - timedelta(
+                days=service.retention_period_days,
+            )
+            dirs_to_delete = []
+            if self.layout.date_fields:
+                dirs_to_delete, files_to_delete = self.layout.expired(
+                    base_dir, cutoff,
+                )
+            elif self.state_db is not None:
+                self.state_db.index_local_files(
+                    service.name, service.host, base_dir,
+                )
+                files_to_delete = self.state_db.expired_local_files(
+                    service.name, service.host,
+                    int(cutoff.strftime("%Y%m%d")),
+                )
+            else:
+                local_files = list(
+                    os.path.join(dirpath, filename)
+                    for dirpath, _, filenames in os.walk(base_dir)
+                    for filename in filenames
+                )
+
+                files_to_delete = filter_older_than(
+                    local_files, service.retention_period_days,
+                )
+
+            for dir_name in dirs_to_delete:
+                if self.verbose or self.dry_run:
+                    print >>out, \
+                        "Deleting directory due to retention policy:", dir_name
+
+                if not self.dry_run:
+                    shutil.rmtree(dir_name)
+                    if self.state_db is not None:
+                        self.state_db.forget_local_dir(dir_name)
+
+            for file_name in files_to_delete:
+                if self.verbose or self.dry_run:
+                    print >>out, \
+                        "Deleting file due to retention policy:", file_name
+
+                if not self.dry_run:
+                    try:
+                        os.remove(file_name)
+                    except OSError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                    if self.state_db is not None:
+                        self.state_db.forget_local_file(file_name)
+
+        return stats
+
+    def _archive_files_concurrently(self, channels, service, files, out,
+                                    stats, removals):
+        """Archive files with one thread per group of SFTP channels. Each
+        thread picks up the largest file that has been found so far as soon as
+        it is free.
+
+        Args:
+            channels(list(list(SFTPClient))): The channels for each thread,
+                see `_archive_file`
+            service(Service)
+            files(iterable(RemoteFile)): The files to archive, which may still
+                be being found
+            out(file): Where to write output to
+            stats(ArchiveStats): Where to record the archived files
+            removals(RemoteRemover): Where to queue files for removal from the
+                remote
+
+        Raises:
+            The first error from archiving any file, once all of the other
+            files have been archived.
+        """
+        # Entries are (priority, sequence, file), where the sequence stops
+        # ties falling through to comparing files. A file of None tells the
+        # thread to stop, and comes after all of the real files.
+        pending = PriorityQueue()
+        sequence = itertools.count()
+        errors = []
+
+        # Output for each file is buffered so that lines printed by
+        # concurrent downloads don't get mangled together.
+        output_lock = threading.Lock()
+
+        def worker(file_channels):
+            while True:
+                _, _, remote_file = pending.get()
+                if remote_file is None:
+                    return
+
+                file_out = StringIO()
+                try:
+                    with self.transfer_slots:
+                        self._archive_file(
+                            file_channels, service, remote_file, file_out,
+                            False, stats, removals,
+                        )
+                except Exception as e:
+                    errors.append(e)
+                    print >>file_out, "Failed to archive %s: %s" % (
+                        remote_file.path, e,
+                    )
+                finally:
+                    with output_lock:
+                        out.write(file_out.getvalue())
+
+        threads = [
+            threading.Thread(target=worker, args=(file_channels,))
+            for file_channels in channels
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for remote_file in files:
+                pending.put((-remote_file.size, next(sequence), remote_file))
+        finally:
+            for _ in threads:
+                pending.put((float("inf"), next(sequence), None))
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def _download_segmented(self, channels, service, remote_file,
+                            pending_name, segments, adaptive, progress_cb):
+        """Download a file as a number of segments in parallel, each over its
+        own SFTP channel and compressed separately, and then join the
+        compressed segments together in order. As with resuming, this relies
+        on the codec decompressing concatenated members as a single stream.
+
+        Args:
+            channels(list(SFTPClient)): The channels to download the segments
+                over, at least one per segment
+            service(Service)
+            remote_file(RemoteFile)
+            pending_name(str): Where to write the compressed file
+            segments(int): Number of segments to split the file into
+            adaptive(AdaptiveLevel|None): Picks the compression level, if the
+                service is configured to use an adaptive level
+            progress_cb(func): Called with the number of bytes downloaded so
+                far and the size of the file
+
+        Returns:
+            int: The number of bytes downloaded
+        """
+        size = remote_file.size
+        bounds = [size * i // segments for i in range(segments + 1)]
+        part_names = [segment_name(pending_name, i) for i in range(segments)]
+
+        progress_lock = threading.Lock()
+        done = [0] * segments
+
+        def download_segment(i):
+            start, end = bounds[i], bounds[i + 1]
+
+            def callback(position, _):
+                with progress_lock:
+                    done[i] = position - start
+                    progress_cb(sum(done), size)
+
+            f = PipelinedWriter(
+                self._open_compressed(
+                    service, open(part_names[i], 'wb'), adaptive,
+                ),
+                rate_observer=adaptive,
+            )
+            with f:
+                return download(
+                    channels[i], remote_file.path, f,
+                    block_size=service.read_block_size,
+                    window=service.read_window,
+                    callback=callback,
+                    offset=start,
+                    size=end,
+                    throttle=self._throttle(service),
+                )
+
+        pool = ThreadPool(segments)
+        try:
+            downloaded = sum(pool.map(download_segment, range(segments)))
+
+            # The other segments are appended to the first, which then becomes
+            # the pending file. They are removed last first, so that if we're
+            # interrupted `remove_segments` still finds all of them.
+            with open(part_names[0], 'ab') as f:
+                for part_name in part_names[1:]:
+                    with open(part_name, 'rb') as part:
+                        shutil.copyfileobj(part, f, COMPRESS_BLOCK_SIZE)
+            for part_name in reversed(part_names[1:]):
+                os.remove(part_name)
+            os.rename(part_names[0], pending_name)
+        finally:
+            pool.close()
+            pool.join()
+            for part_name in reversed(part_names):
+                if os.path.exists(part_name):
+                    os.remove(part_name)
+
+        return downloaded
+
+    def migrate_layout(self, service, from_layout, out=None):
+        """Move the archived files of a service from where an old layout put
+        them to where the current layout puts them.
+
+        Args:
+            service(Service)
+            from_layout(Layout): The layout the files are currently in
+            out(file): Where to write output to, defaults to stdout
 
-            if os.path.exists(local_name):
-                print "Warning: ", local_name, "already exists"
+        Returns:
+            int: The number of files moved
+        """
+        if out is None:
+            out = sys.stdout
+
+        old_root = os.path.join(
+            self.base_dir, from_layout.root(service.name, service.host),
+        )
+
+        # Get the full list before moving anything, in case files are moved
+        # to somewhere we have yet to walk.
+        old_paths = [
+            os.path.join(dirpath, filename)
+            for dirpath, _, filenames in walk(old_root)
+            for filename in filenames
+        ]
+
+        moved = 0
+        for old_path in sorted(old_paths):
+            new_path = self.layout.path(
+                service.name, service.host, os.path.basename(old_path),
+            )
+            if new_path is None:
+                print >>out, "Warning: ", old_path, "has no date. Ignoring."
+                continue
+            new_path = os.path.join(self.base_dir, new_path)
+            if new_path == old_path:
+                continue
+            if os.path.exists(new_path):
+                print >>out, "Warning: ", new_path, "already exists"
                 continue
 
-            # Set up progress bar for downloads
+            if self.verbose or self.dry_run:
+                print >>out, "Moving %s to %s" % (old_path, new_path)
+
+            if not self.dry_run:
+                ensure_dir(os.path.dirname(new_path))
+                os.rename(old_path, new_path)
+                if self.state_db is not None:
+                    self.state_db.move_local_file(old_path, new_path)
+            moved += 1
+
+        # Tidy up any directories that have been left empty
+        if not self.dry_run:
+            for dirpath, _, _ in walk(old_root, topdown=False):
+                if dirpath != old_root and not os.listdir(dirpath):
+                    os.rmdir(dirpath)
+
+        return moved
+
+    def _archive_file(self, channels, service, remote_file, out,
+                      show_progress, stats, removals):
+        """Download a single remote file into the archive, optionally removing
+        it from the remote afterwards.
+
+        Args:
+            channels(list(SFTPClient)): The SFTP channels to download the file
+                over. Only the first is used unless the file is split into
+                segments, in which case there can be up to one segment per
+                channel.
+            service(Service)
+            remote_file(RemoteFile): The file on the remote
+            out(file): Where to write output to
+            show_progress(bool): Whether to show a progress bar
+            stats(ArchiveStats): Where to record the archived file
+            removals(RemoteRemover): Where to queue the file for removal from
+                the remote, with `--remove`
+        """
+        file_name = remote_file.path
+        sftp = channels[0]
+
+        # Files that are already compressed are archived as is
+        compress = not file_name.endswith(COMPRESSED_EXTENSIONS)
+
+        # The date that makes the file old enough to archive may be in the
+        # name of a directory rather than of the file, in which case a layout
+        # by date has nowhere to put it.
+        local_name = self.layout.path(
+            service.name, service.host, posixpath.basename(file_name),
+        )
+        if local_name is None:
+            print >>out, "Warning: ", file_name, \
+                "has no date in its name for the layout. Ignoring."
+            return
+        local_name = os.path.join(self.base_dir, local_name)
+        if compress:
+            local_name += service.codec.extension
+        pending_name = local_name + ".download"
+
+        if self.state_db is not None and self.state_db.is_archived(
+            service.name, service.host, file_name,
+        ):
             if self.verbose:
-                widgets = [
-                    os.path.basename(file_name), " ",
-                    progressbar.Percentage(),
-                    ' ', progressbar.Bar(),
-                    ' ', progressbar.ETA(),
-                    ' ', progressbar.FileTransferSpeed(),
-                ]
-                pb = progressbar.ProgressBar(widgets=widgets)
-
-                def progress_cb(bytes_downloaded, total_size):
-                    pb.max_value = total_size
-                    pb.update(bytes_downloaded)
-            else:
-                def progress_cb(bytes_downloaded, total_size):
-                    pass
+                print >>out, "Already archived:", file_name
+            if not self.dry_run:
+                remove_partial(pending_name)
+            return
 
-            if self.verbose or self.dry_run:
-                print "Archiving: %s:%s to %s" % (
-                    service.host, file_name, local_name,
+        if os.path.exists(local_name):
+            print >>out, "Warning: ", local_name, "already exists"
+            if not self.dry_run:
+                remove_partial(pending_name)
+            return
+
+        # When compressing on the remote we don't know how big the compressed
+        # file will be, so can't show progress.
+        remote_compress = compress and service.remote_compression
+        if remote_compress:
+            show_progress = False
+
+        # Set up progress bar for downloads
+        if show_progress:
+            widgets = [
+                os.path.basename(file_name), " ",
+                progressbar.Percentage(),
+                ' ', progressbar.Bar(),
+                ' ', progressbar.ETA(),
+                ' ', progressbar.FileTransferSpeed(),
+            ]
+            pb = progressbar.ProgressBar(widgets=widgets)
+
+            def progress_cb(bytes_downloaded, total_size):
+                pb.max_value = total_size
+                pb.update(bytes_downloaded)
+        else:
+            def progress_cb(bytes_downloaded, total_size):
+                pass
+
+        if self.verbose or self.dry_run:
+            print >>out, "Archiving: %s:%s to %s" % (
+                service.host, file_name, local_name,
+            )
+
+        if not self.dry_run:
+            ensure_dir(os.path.dirname(local_name))
+
+            # Segments of an interrupted segmented download can't be resumed
+            remove_segments(pending_name)
+
+            # If a previous run was interrupted part way through downloading
+            # the file we carry on from where it got to. Remote compression
+            # is a single stream so can't be resumed.
+            offset = 0
+            if os.path.exists(pending_name):
+                if remote_compress:
+                    remove_partial(pending_name)
+                else:
+                    offset = self._resume_offset(
+                        remote_file, pending_name, compress,
+                    )
+                    if offset and self.verbose:
+                        print >>out, "Resuming from byte", offset
+
+            # If the file isn't already compressed then we compress while
+            # we download, in a separate thread so that the download doesn't
+            # stall while blocks are being compressed.
+            # If configured to, we instead have the remote compress the file
+            # and stream us the result.
+            # TODO: Should we be preserving last modified times?
+            if remote_compress:
+                command = service.codec.remote_command(
+                    file_name, service.compression_level,
                 )
+                with open(pending_name, 'wb') as f:
+                    size = download_command_output(
+                        sftp, command, f, block_size=service.read_block_size,
+                        throttle=self._throttle(service),
+                    )
+                stats.add_file(size)
 
-            if not self.dry_run:
-                # If filename does not end with '.gz' then we compress while
-                # we download
-                # TODO: Should we be preserving last modified times?
-                if not file_name.endswith(".gz"):
-                    with gzip.open(pending_name, 'wb', compresslevel=9) as f:
-                        sftp.getfo(file_name, f, callback=progress_cb)
+                # We never see the uncompressed contents, so can't checksum
+                # them as they are downloaded
+                digest = None
+            else:
+                digest = None
+                if self.state_db is not None or self.verify:
+                    digest = hashlib.sha256()
+
+                adaptive = None
+                if compress and service.compression_level == ADAPTIVE_LEVEL:
+                    adaptive = AdaptiveLevel()
+
+                # Large files can be split into segments that are downloaded
+                # and compressed in parallel.
+                segments = 1
+                if compress and not offset:
+                    segments = min(
+                        len(channels),
+                        remote_file.size // SEGMENT_MIN_SIZE,
+                    )
+
+                # Each extra segment counts as a download of its own against
+                # `max_transfers`. We already hold a slot for this file, so
+                # rather than wait for more (and risk deadlocking with other
+                # files doing the same) we only split the file into as many
+                # segments as there are free slots for.
+                extra_slots = 0
+                while (
+                    extra_slots < segments - 1 and
+                    self.transfer_slots.acquire(False)
+                ):
+                    extra_slots += 1
+                segments = extra_slots + 1
+
+                if segments > 1:
+                    # The segments are downloaded out of order, so we have
+                    # to checksum the file at the end.
+                    digest = None
+                    f = None
+                elif compress:
+                    def open_member(fileobj):
+                        return self._open_compressed(
+                            service, fileobj, adaptive,
+                        )
+
+                    f = PipelinedWriter(
+                        CheckpointingWriter(pending_name, open_member, offset),
+                        rate_observer=adaptive,
+                    )
+
+                    # We'd have to decompress what we already have to
+                    # checksum it, so we leave that until the end.
+                    if offset:
+                        digest = None
                 else:
-                    sftp.get(file_name, pending_name, callback=progress_cb)
+                    if digest is not None and offset:
+                        hash_file(pending_name, digest)
+                    f = open(pending_name, 'ab')
 
+                if f is None:
+                    try:
+                        size = self._download_segmented(
+                            channels, service, remote_file, pending_name,
+                            segments, adaptive, progress_cb,
+                        )
+                    finally:
+                        for _ in range(extra_slots):
+                            self.transfer_slots.release()
+                else:
+                    with f:
+                        size = download(
+                            sftp, file_name, f,
+                            block_size=service.read_block_size,
+                            window=service.read_window,
+                            callback=progress_cb,
+                            digest=digest,
+                            offset=offset,
+                            size=remote_file.size,
+                            throttle=self._throttle(service),
+                        )
+                stats.add_file(size, adaptive)
+
+            if show_progress:
+                pb.finish()
+
+            # Normally the checksum is worked out as the file downloads, but
+            # otherwise we have to go back over what we've written. If we're
+            # only recording it we don't need the codec's package installed
+            # locally, and go without if it isn't.
+            codec = service.codec if compress else None
+            if digest is None and (
+                self.verify or (
+                    self.state_db is not None and
+                    (codec is None or codec.module is not None)
+                )
+            ):
+                digest = hashlib.sha256()
+                hash_file(pending_name, digest, codec=codec)
+
+            if self.verify:
+                expected = remote_checksum(sftp, file_name)
+                if digest.hexdigest() != expected:
+                    remove_partial(pending_name)
+                    raise Exception(
+                        "Checksum of %s does not match remote" % (file_name,)
+                    )
+                if self.verbose:
+                    print >>out, "Verified checksum of", file_name
+
+            os.rename(pending_name, local_name)
+
+            if self.state_db is not None:
+                self.state_db.record(
+                    service.name, service.host, file_name,
+                    size=remote_file.size,
+                    mtime=remote_file.mtime,
+                    checksum=digest.hexdigest() if digest else None,
+                    local_path=local_name,
+                    codec=service.codec.name if compress else None,
+                )
+
+            if self.remove:
                 if self.verbose:
-                    pb.finish()
+                    print >>out, "Removing remote", file_name
+                removals.add(sftp, file_name)
 
-                os.rename(pending_name, local_name)
 
-                if self.remove:
-                    if self.verbose:
-                        print "Removing remote"
-                    sftp.remove(file_name)
+def service_from_config(name, host, serv_config):
+    """Build the Service for one of the hosts of a service in the config
 
-        sftp.close()
-        client.close()
+    Args:
+        name(str): Name of the service
+        host(str)
+        serv_config(dict): The config for the service
 
-        # We now go and delete any files that are older than the retention
-        # period, if specified
-        if service.retention_period_days:
-            local_files = list(
-                os.path.join(dirpath, filename)
-                for dirpath, _, filenames in os.walk(base_dir)
-                for filename in filenames
-            )
+    Returns:
+        Service
+    """
+    compression = serv_config.get("compression", {})
+    remote_compression = compression.get("remote", False)
+    codec = get_codec(
+        compression.get("codec", "gzip"), local=not remote_compression,
+    )
+    level = compression.get("level", codec.default_level)
+
+    if level == ADAPTIVE_LEVEL and (
+        codec.name != "gzip" or remote_compression
+    ):
+        raise ValueError(
+            "Adaptive compression level is only supported when compressing"
+            " locally with gzip"
+        )
 
-            files_to_delete = filter_by_age(
-                local_files,
-                lambda d: d.days > service.retention_period_days
+    sftp_channels = serv_config.get("sftp_channels", 1)
+    segments = serv_config.get("segments", 1)
+    if segments < 1:
+        raise ValueError("segments must be at least 1")
+    if segments > 1:
+        sessions = sessions_needed(sftp_channels, segments)
+        if sessions > MAX_SESSIONS:
+            raise ValueError(
+                "sftp_channels of %d with segments of %d could need %d"
+                " sessions on the connection to %s, more than the %d"
+                " allowed" % (
+                    sftp_channels, segments, sessions, host, MAX_SESSIONS,
+                )
             )
 
-            for file_name in files_to_delete:
-                if self.verbose or self.dry_run:
-                    print "Deleting file due to retention policy: %s" % (
-                        file_name,
-                    )
+    return Service(
+        name=name,
+        host=host,
+        account=serv_config["account"],
+        directory=serv_config["directory"],
+        pattern=serv_config["pattern"],
+        days_to_keep_on_remote=serv_config["days_to_keep_on_remote"],
+        retention_period_days=serv_config.get("retention_period_days"),
+        sftp_channels=sftp_channels,
+        read_block_size=serv_config.get(
+            "read_block_size", DEFAULT_READ_BLOCK_SIZE,
+        ),
+        read_window=serv_config.get("read_window", DEFAULT_READ_WINDOW),
+        codec=codec,
+        compression_level=level,
+        remote_compression=remote_compression,
+        bandwidth_limit=RateSchedule.from_config(
+            serv_config.get("bandwidth_limit"),
+        ),
+        segments=segments,
+    )
 
-                if not self.dry_run:
-                    os.remove(file_name)
+
+def sessions_needed(sftp_channels, segments):
+    """The most sessions a service could have open on its connection at once.
+    Each of its `sftp_channels` has `segments` SFTP sessions (one per segment
+    of a split file, which are kept open between files) and may run a command
+    on the remote alongside them (e.g. `rm` or `sha256sum`), and the `find`
+    listing the files runs while they download.
+
+    Returns:
+        int
+    """
+    return sftp_channels * (segments + 1) + 1
+
+
+def group_by_host(services):
+    """Group services by the (host, account) they connect to, preserving the
+    order in which they first appear.
+
+    Returns:
+        list(list(Service))
+    """
+    groups = OrderedDict()
+    for service in services:
+        groups.setdefault((service.host, service.account), []).append(service)
+    return list(groups.values())
+
+
+def archive_services(archiver, services, jobs=1):
+    """Archive the given services, handling up to `jobs` hosts concurrently.
+
+    Services on the same host and account are handled one after the other by
+    the same job, so that they can share a single connection. Services that
+    also share a directory are listed together with one `find`. If there is a
+    state database, hosts that have had the most data to archive recently
+    are started first, so that they don't end up holding up the whole run.
+
+    When running more than one job the output of each host is buffered and
+    printed in one go once the host has been handled, so that output for
+    different hosts doesn't get interleaved.
+
+    Args:
+        archiver(Archiver)
+        services(list(Service))
+        jobs(int): Number of hosts to archive concurrently
+
+    Returns:
+        list((Service, Exception|None, ArchiveStats|None)): The services that
+        were handled along with the error that was raised, if any, or the
+        stats if archiving succeeded.
+    """
+    output_lock = threading.Lock()
+
+    def run(host_services):
+        out = StringIO() if jobs > 1 else sys.stdout
+
+        # Listings of directories shared by several services, which are
+        # fetched when the first of the services is handled.
+        listings = {}
+
+        results = []
+        for service in host_services:
+            if archiver.verbose:
+                print >>out, "Handling", service.name, service.host
+
+            error = None
+            stats = None
+            try:
+                remote_files = None
+                directory = service.directory
+                shared = [s for s in host_services if s.directory == directory]
+                if len(shared) > 1:
+                    if service not in listings:
+                        listings.update(archiver.list_services(shared))
+                    remote_files = listings.pop(service)
+
+                stats = archiver.archive_service(service, out, remote_files)
+            except Exception as e:
+                print >>out, "Error while processing", service.name, \
+                    service.host, e
+                error = e
+
+                # Don't reuse a connection that may be in a bad state
+                archiver.connections.discard(service.host, service.account)
+
+            results.append((service, error, stats))
+
+        if out is not sys.stdout:
+            with output_lock:
+                sys.stdout.write(out.getvalue())
+                sys.stdout.flush()
+
+        return results
+
+    groups = group_by_host(services)
+
+    if archiver.state_db is not None and jobs > 1:
+        groups.sort(
+            key=lambda group: sum(
+                archiver.state_db.recent_bytes(s.name, s.host) for s in group
+            ),
+            reverse=True,
+        )
+
+    if jobs <= 1:
+        return [r for group in groups for r in run(group)]
+
+    pool = ThreadPool(jobs)
+    try:
+        return [r for rs in pool.imap_unordered(run, groups) for r in rs]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def print_summary(results, verbose=False):
+    """Print a summary of which services succeeded and which failed
+
+    Args:
+        results(list): As returned by `archive_services`
+        verbose(bool): Also print what was archived for each service
+    """
+    failures = [(s, e) for s, e, _ in results if e is not None]
+    print "Archived %d of %d services, %d failed" % (
+        len(results) - len(failures), len(results), len(failures),
+    )
+    for service, error in failures:
+        print "Failed: %s %s: %s" % (service.name, service.host, error)
+
+    if not verbose:
+        return
+
+    for service, _, stats in results:
+        if stats is None:
+            continue
+        line = "%s %s: %d files, %d bytes" % (
+            service.name, service.host, stats.files, stats.bytes,
+        )
+        if stats.compression_levels:
+            line += ", adaptive levels: " + stats.describe_levels()
+        print line
 
 
 if __name__ == "__main__":
@@ -218,36 +2987,86 @@ if __name__ == "__main__":
     parser.add_argument("--use-ssh-agent",
                         help="allow using keys from ssh agent",
                         action="store_true")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of hosts to archive concurrently")
+    parser.add_argument("--max-transfers", type=int,
+                        help="maximum number of files to download at once,"
+                             " across all hosts")
+    parser.add_argument("--verify",
+                        help="check checksums of downloaded files against"
+                             " the remote",
+                        action="store_true")
+    parser.add_argument("--compress-threads", type=int, default=1,
+                        help="number of threads to use to compress files")
+    parser.add_argument("--full-scan",
+                        help="look for all matching files on the remote, not"
+                             " just those newer than already archived",
+                        action="store_true")
+    parser.add_argument("--migrate-layout",
+                        help="move archived files from the old layout to the"
+                             " configured layout, and then exit",
+                        action="store_true")
+    parser.add_argument("--old-layout", default=DEFAULT_LAYOUT,
+                        help="the layout to migrate from (default: %s)" % (
+                            DEFAULT_LAYOUT.replace("%", "%%"),
+                        ))
     args = parser.parse_args()
 
     config_file = args.config
     config = yaml.load(open(config_file))
 
     base_dir = config["archive_dir"]
+    layout = Layout(config.get("layout", DEFAULT_LAYOUT))
 
     services = [
-        Service(
-            name=name,
-            host=host,
-            account=serv_config["account"],
-            directory=serv_config["directory"],
-            pattern=serv_config["pattern"],
-            days_to_keep_on_remote=serv_config["days_to_keep_on_remote"],
-            retention_period_days=serv_config.get("retention_period_days"),
-        )
+        service_from_config(name, host, serv_config)
         for name, serv_config in config["services"].iteritems()
         for host in serv_config["hosts"]
     ]
 
+    state_db = None
+    if config.get("state_db"):
+        state_db = StateDB(config["state_db"])
+
+    # Progress bars from concurrent jobs would just trample over each other
     archiver = Archiver(
-        base_dir, args.verbose, args.dry_run, args.remove, args.use_ssh_agent
+        base_dir, args.verbose, args.dry_run, args.remove, args.use_ssh_agent,
+        show_progress=args.verbose and args.jobs <= 1,
+        compress_threads=args.compress_threads,
+        state_db=state_db,
+        bandwidth_limit=RateSchedule.from_config(
+            config.get("bandwidth_limit"),
+        ),
+        host_bandwidth_limit=RateSchedule.from_config(
+            config.get("host_bandwidth_limit"),
+        ),
+        verify=args.verify,
+        layout=layout,
+        full_scan=args.full_scan,
+        max_transfers=args.max_transfers,
     )
 
-    for service in services:
-        if args.verbose:
-            print "Handling", service.name, service.host
-
+    if args.migrate_layout:
+        from_layout = Layout(args.old_layout)
         try:
-            archiver.archive_service(service)
-        except Exception as e:
-            print "Error while processing", service.name, service.host, e
+            for service in services:
+                moved = archiver.migrate_layout(service, from_layout)
+                if args.verbose:
+                    print "Moved %d files for %s %s" % (
+                        moved, service.name, service.host,
+                    )
+        finally:
+            archiver.close()
+        sys.exit(0)
+
+    try:
+        results = archive_services(archiver, services, args.jobs)
+    finally:
+        archiver.close()
+
+    failed = any(error is not None for _, error, _ in results)
+    if args.verbose or failed:
+        print_summary(results, args.verbose)
+
+    if failed:
+        sys.exit(1)